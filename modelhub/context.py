@@ -1,16 +1,142 @@
+import base64
+import os
+import struct
+import sys
+from math import ceil
 from typing import List, Dict
 
+# 消息中反复出现的角色和内容类型取值，显式驻留保证比较和字典查找走指针相等的快速路径
+ROLE_SYSTEM = sys.intern("system")
+ROLE_USER = sys.intern("user")
+ROLE_ASSISTANT = sys.intern("assistant")
+CONTENT_TYPE_TEXT = sys.intern("text")
+CONTENT_TYPE_IMAGE_URL = sys.intern("image_url")
+
+# 消息类型标记：纯文本消息 / 图文混合消息
+KIND_TEXT = "text"
+KIND_MULTIMODAL = "multimodal"
+
+# OpenAI图片token计算：低精度固定85；高精度为85加上每个512x512切片170
+_IMAGE_BASE_TOKENS = 85
+_IMAGE_TILE_TOKENS = 170
+# 高精度但无法得知图片尺寸时（如图片url），按常见的2x2切片估算
+_IMAGE_DEFAULT_TILES = 4
+# 解析图片尺寸时解码的base64长度，JPEG的尺寸信息可能位于EXIF等数据段之后，约对应64KB文件头
+_IMAGE_HEADER_BASE64_LENGTH = 87384
+
+
+def _image_size_from_base64(base64_image: str):
+    """
+    从base64编码图片的文件头解析宽高，支持PNG、JPEG、GIF、WebP
+    :param base64_image: 图片的base64编码
+    :return: (宽, 高)，无法解析时返回None
+    """
+    try:
+        head = base64.b64decode(base64_image[:_IMAGE_HEADER_BASE64_LENGTH])
+    except Exception:
+        return None
+    if head.startswith(b"\x89PNG\r\n\x1a\n") and len(head) >= 24:
+        return struct.unpack(">II", head[16:24])
+    if head[:6] in (b"GIF87a", b"GIF89a") and len(head) >= 10:
+        return struct.unpack("<HH", head[6:10])
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP" and len(head) >= 30:
+        chunk = head[12:16]
+        if chunk == b"VP8X":
+            return int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", head[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L":
+            bits = int.from_bytes(head[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        return None
+    if head.startswith(b"\xff\xd8"):
+        # 逐个跳过JPEG数据段，直到SOF段
+        i = 2
+        while i + 9 <= len(head):
+            if head[i] != 0xFF:
+                return None
+            marker = head[i + 1]
+            if marker == 0xFF:
+                i += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                i += 2
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", head[i + 5:i + 9])
+                return width, height
+            i += 2 + struct.unpack(">H", head[i + 2:i + 4])[0]
+    return None
+
+
+def _image_tokens(detail: str, size=None) -> int:
+    """
+    按OpenAI的图片计费规则计算单张图片的token数
+    :param detail: 图片精度，low/high/auto，None表示由平台决定
+    :param size: 图片(宽, 高)，未知时为None
+    :return: token数
+    """
+    if detail == "low":
+        return _IMAGE_BASE_TOKENS
+    if not size or not size[0] or not size[1]:
+        # 尺寸未知时，明确要求高精度的按默认切片数估算，其余沿用低精度的估算
+        if detail == "high":
+            return _IMAGE_BASE_TOKENS + _IMAGE_TILE_TOKENS * _IMAGE_DEFAULT_TILES
+        return _IMAGE_BASE_TOKENS
+    width, height = size
+    # 先等比缩放到2048x2048以内，再将短边缩放到768
+    scale = min(1, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return _IMAGE_BASE_TOKENS + _IMAGE_TILE_TOKENS * ceil(width / 512) * ceil(height / 512)
+
+
+# 待编码文本达到该数量时才批量编码：encode_ordinary_batch每次调用都会新建线程池，文本较少时逐条编码更快
+_BATCH_ENCODE_THRESHOLD = 64
+
+
+def _encode_texts(encoding, texts: List[str]) -> List[List[int]]:
+    """
+    将多段文本编码为token
+    :param encoding: tiktoken编码器
+    :param texts: 文本列表
+    :return: 与texts一一对应的token列表
+    """
+    if len(texts) >= _BATCH_ENCODE_THRESHOLD:
+        return encoding.encode_ordinary_batch(texts, num_threads=os.cpu_count() or 1)
+    return [encoding.encode_ordinary(text) for text in texts]
+
+
+# 上下文中的单条消息
+class Message:
+    # 使用__slots__代替字典存储消息，长对话下内存占用更小、属性访问更快
+    __slots__ = ("role", "content", "kind", "image_tokens", "tokens")
+
+    def __init__(self, role: str, content, kind: str = KIND_TEXT, image_tokens: int = 0):
+        self.role = role
+        # 纯文本消息为字符串，图文混合消息为OpenAI格式的内容列表
+        self.content = content
+        self.kind = kind
+        # 消息中图片的token数，添加图片消息时计算
+        self.image_tokens = image_tokens
+        # token数缓存，统计时按需计算
+        self.tokens = None
+
+    def __repr__(self):
+        return f"Message(role={self.role!r}, content={self.content!r})"
+
 
 # 上下文基类
 class Context:
     def __init__(self, system_prompt: str):
         # 历史消息
-        self.messages: List[Dict] = [
-            {
-                "role": "system",
-                "content": system_prompt,
-            }
-        ]
+        self.messages: List[Message] = [Message(ROLE_SYSTEM, system_prompt)]
+        # 消息中缓存的token数对应的编码器
+        self._token_encoding_name = None
+        # 是否包含图文混合消息，纯文本上下文走不区分消息类型的快速路径
+        self._has_multimodal = False
 
     def add_user_message(self, content: str):
         """
@@ -38,14 +164,70 @@ class Context:
         """
         pass
 
+    def to_openai_messages(self) -> List[Dict]:
+        """
+        将历史消息转换为OpenAI API请求使用的消息列表
+        :return: 消息字典列表
+        """
+        return [{"role": m.role, "content": m.content} for m in self.messages]
+
+    @staticmethod
+    def _split_message(message: Message) -> List[str]:
+        """
+        拆分出单条消息中需要编码的文本
+        :param message: 消息
+        :return: 文本列表
+        """
+        texts = []
+        if message.role:
+            texts.append(message.role)
+        if message.kind == KIND_TEXT:
+            texts.append(str(message.content or ""))
+        # 图片消息只编码其中的文本，图片token数在添加消息时已算好
+        else:
+            for item in message.content:
+                if item.get("type") == CONTENT_TYPE_TEXT:
+                    texts.append(str(item.get("text", "")))
+        return texts
+
+    def count_tokens(self, encoding) -> int:
+        """
+        统计上下文中的token总数，已统计过的消息直接使用缓存
+        :param encoding: tiktoken编码器
+        :return: token总数
+        """
+        # 换了编码器时，缓存失效
+        if encoding.name != self._token_encoding_name:
+            for message in self.messages:
+                message.tokens = None
+            self._token_encoding_name = encoding.name
+        pending = [m for m in self.messages if m.tokens is None]
+        if pending and not self._has_multimodal:
+            # 纯文本上下文每条消息固定为角色和内容两段文本，无需逐条拆分
+            texts = [None] * (2 * len(pending))
+            texts[0::2] = [m.role for m in pending]
+            texts[1::2] = [str(m.content or "") for m in pending]
+            encoded = _encode_texts(encoding, texts)
+            for i, message in enumerate(pending):
+                message.tokens = len(encoded[2 * i]) + len(encoded[2 * i + 1])
+        elif pending:
+            # 新增消息的文本合并后统一编码，较多时走批量编码
+            texts = []
+            spans = []
+            for message in pending:
+                message_texts = self._split_message(message)
+                spans.append((len(texts), len(texts) + len(message_texts)))
+                texts.extend(message_texts)
+            encoded = _encode_texts(encoding, texts)
+            for message, (start, end) in zip(pending, spans):
+                tokens = sum(len(encoded[i]) for i in range(start, end))
+                message.tokens = tokens + message.image_tokens
+        return sum(m.tokens for m in self.messages)
+
     # 清除对话历史记录
     def clear_history(self):
-        self.messages = [
-            {
-                "role": "system",
-                "content": self.messages[0]["content"],
-            }
-        ]
+        self.messages = [Message(ROLE_SYSTEM, self.messages[0].content)]
+        self._has_multimodal = False
 
 
 # OpenAI API兼容 上下文类
@@ -56,45 +238,41 @@ class OpenAIContext(Context):
         self.clear_history()
 
     def add_user_message(self, content: str):
-        self.messages.append({
-            "role": "user",
-            "content": content,
-        })
+        self.messages.append(Message(ROLE_USER, content))
 
     def add_assistant_message(self, content: str):
-        self.messages.append({
-            "role": "assistant",
-            "content": content,
-        })
+        self.messages.append(Message(ROLE_ASSISTANT, content))
 
-    def add_image_message(self, text_content: str, base64_image_list: list = None, image_url_list: list = None):
+    def add_image_message(self, text_content: str, base64_image_list: list = None, image_url_list: list = None, detail: str = None):
         if base64_image_list is None and image_url_list is None:
             raise ValueError("必须提供 base64_image_list 或 image_url_list")
+        image_tokens = 0
+        # 图片数量已知，按长度预先分配列表，首项为文本内容
         if base64_image_list is not None:
-            content_ = [{"type": "text", "text": str(text_content)}]
-            for base64_image in base64_image_list:
-                content_.append({
-                    "type": "image_url",
+            detail = detail or "low"
+            content_ = [None] * (len(base64_image_list) + 1)
+            for i, base64_image in enumerate(base64_image_list, 1):
+                content_[i] = {
+                    "type": CONTENT_TYPE_IMAGE_URL,
                     "image_url": {
                         "url": f"data:image/png;base64,{base64_image}",
-                        "detail": "low"
-                    }
-                })
-            self.messages.append({
-                "role": "user",
-                "content": content_,
-            })
-
-        elif image_url_list is not None:
-            content_ = [{"type": "text", "text": str(text_content)}]
-            for image_url in image_url_list:
-                content_.append({
-                    "type": "image_url",
-                    "image_url": {
-                        "url": image_url,
+                        "detail": detail
                     }
-                })
-            self.messages.append({
-                "role": "user",
-                "content": content_,
-            })
+                }
+                # 低精度图片的token数固定，无需解析图片尺寸
+                size = None if detail == "low" else _image_size_from_base64(base64_image)
+                image_tokens += _image_tokens(detail, size)
+        else:
+            content_ = [None] * (len(image_url_list) + 1)
+            for i, image_url in enumerate(image_url_list, 1):
+                image_url_ = {"url": image_url}
+                if detail:
+                    image_url_["detail"] = detail
+                content_[i] = {
+                    "type": CONTENT_TYPE_IMAGE_URL,
+                    "image_url": image_url_,
+                }
+                image_tokens += _image_tokens(detail)
+        content_[0] = {"type": CONTENT_TYPE_TEXT, "text": str(text_content)}
+        self.messages.append(Message(ROLE_USER, content_, KIND_MULTIMODAL, image_tokens))
+        self._has_multimodal = True
@@ -1,15 +1,151 @@
+import asyncio
+import atexit
 import os
+import time
 import re, json
 from abc import ABC, abstractmethod
+from functools import lru_cache
 
 from dotenv import load_dotenv
-from openai import AsyncOpenAI, OpenAI
+import httpx
+from openai import AsyncOpenAI, BadRequestError, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI, OpenAIError
 import tiktoken
 
-from modelhub.context import OpenAIContext
+from modelhub.context import OpenAIContext, ROLE_USER
+
+try:
+    # orjson为可选依赖，解析速度明显快于标准库json
+    import orjson
+
+    def _loads(s):
+        return orjson.loads(s if isinstance(s, (bytes, str)) else str(s))
+except ImportError:
+    _loads = json.loads
 
 load_dotenv()
 
+# 各平台的API Key，在加载.env之后从环境变量统一读取一次，创建Dialog时不再访问环境变量
+_API_KEYS = {k: os.environ.get(k) for k in ("OPENROUTER_API_KEY", "OPENAI_API_KEY", "VOLC_API_KEY", "DMX_API_KEY")}
+
+
+def _get_api_key(api_key_env: str):
+    """
+    获取环境变量中的API Key，未预先读取的变量名在首次使用时读取并缓存
+    :param api_key_env: API Key对应的环境变量名
+    :return: API Key，未设置时为None
+    """
+    if api_key_env not in _API_KEYS:
+        _API_KEYS[api_key_env] = os.environ.get(api_key_env)
+    return _API_KEYS[api_key_env]
+
+# 进程内所有Dialog共享的HTTP连接池，复用keep-alive连接，避免每个实例各自建连和TLS握手
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+
+
+class _SharedHttpxClient(DefaultHttpxClient):
+    # 共享连接池不随单个OpenAI客户端的close()或with语句关闭，只在进程退出时关闭
+    def close(self) -> None:
+        pass
+
+
+class _SharedAsyncHttpxClient(DefaultAsyncHttpxClient):
+    # 共享连接池不随单个AsyncOpenAI客户端的close()或async with语句关闭
+    async def aclose(self) -> None:
+        pass
+
+
+_HTTP_CLIENT = _SharedHttpxClient(limits=_HTTP_LIMITS)
+# 异步连接池中的连接属于创建它的事件循环，因此每个事件循环各用一个连接池。
+# 池中的连接会引用所属的事件循环，用弱引用字典无法自动释放，查找时主动清理已关闭的事件循环
+_ASYNC_HTTP_CLIENTS = {}
+
+
+def _drop_closed_loops(clients: dict):
+    """
+    移除已关闭事件循环对应的客户端，释放其连接池和连接
+    :param clients: 事件循环 -> 客户端 的字典
+    """
+    for loop in [loop for loop in clients if loop.is_closed()]:
+        del clients[loop]
+
+
+def _get_async_http_client(loop: asyncio.AbstractEventLoop) -> httpx.AsyncClient:
+    """
+    获取事件循环对应的共享异步连接池
+    :param loop: 当前运行的事件循环
+    :return: 异步HTTP客户端
+    """
+    http_client = _ASYNC_HTTP_CLIENTS.get(loop)
+    if http_client is None:
+        _drop_closed_loops(_ASYNC_HTTP_CLIENTS)
+        http_client = _SharedAsyncHttpxClient(limits=_HTTP_LIMITS)
+        _ASYNC_HTTP_CLIENTS[loop] = http_client
+    return http_client
+
+
+@atexit.register
+def _close_http_clients():
+    httpx.Client.close(_HTTP_CLIENT)
+
+
+@lru_cache(maxsize=32)
+def _get_encoding(model_name: str) -> tiktoken.Encoding:
+    """
+    获取模型对应的tiktoken编码器，进程内按模型名缓存，避免每次计数都重新加载BPE
+    :param model_name: 模型名称
+    :return: tiktoken编码器，tiktoken不认识的模型回退到cl100k_base
+    """
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# 限流、连接失败和服务端错误时的最大重试次数，由OpenAI SDK按指数退避重试（会遵循Retry-After）
+_MAX_RETRIES = 4
+
+
+# 要求模型以JSON格式输出的附加消息
+_JSON_OUTPUT_MESSAGE = {"role": ROLE_USER, "content": "输出为JSON格式"}
+
+# 平台原生的JSON输出模式
+_JSON_RESPONSE_FORMAT = {"type": "json_object"}
+
+
+def _is_response_format_error(error: BadRequestError) -> bool:
+    """
+    判断请求错误是否由平台不支持response_format参数引起
+    :param error: 请求返回的400错误
+    :return: 是否为response_format不受支持
+    """
+    if error.param == "response_format":
+        return True
+    message = str(error.message).lower()
+    return "response_format" in message or "json_object" in message
+
+
+# 模型回复中的JSON代码块
+_JSON_BLOCK_RE = re.compile(r"```json\s*([\s\S]*?)\s*```")
+# 模型回复中的JSON数组或对象
+_JSON_BRACE_RE = re.compile(r"(\[[\s\S]*\]|\{[\s\S]*\})")
+
+
+def _extract_json(text: str) -> str:
+    """
+    从模型回复中提取JSON字符串，提取不到时返回原文本
+    :param text: 模型回复内容
+    :return: JSON字符串
+    """
+    # 优先提取代码块里的内容
+    match = _JSON_BLOCK_RE.search(text)
+    if match:
+        return match.group(1)
+    # 匹配数组或对象
+    match = _JSON_BRACE_RE.search(text)
+    if match:
+        return match.group(1)
+    return text
+
 
 class Dialog(ABC):
     def __init__(self, model_name: str):
@@ -17,6 +153,9 @@ class Dialog(ABC):
         self.api_key = None
         self.top_p = 1
         self.temperature = 0.3
+        # 需要JSON输出时是否使用平台原生的JSON模式（response_format），默认关闭，平台不支持时会自动关闭。
+        # 开启后模型只能返回JSON对象（字典），不能直接返回数组
+        self.json_mode = False
 
     @property
     @abstractmethod
@@ -50,19 +189,8 @@ class Dialog(ABC):
         计算当前上下文中的token使用量
         :return: token总数
         """
-        encoding = tiktoken.encoding_for_model(self.model_name)
-        total_tokens = 0
-        for message in self.context.messages:
-            if message.get("role"):
-                total_tokens += len(encoding.encode(message["role"]))
-                if isinstance(message.get("content"), str):
-                    total_tokens += len(encoding.encode(message["content"]))
-            # 更健壮地处理图片消息
-            if isinstance(message.get("content"), list):
-                for item in message["content"]:
-                    if item.get("type") == "image_url":
-                        total_tokens += 85
-        return total_tokens
+        encoding = _get_encoding(self.model_name)
+        return self.context.count_tokens(encoding)
 
     @staticmethod
     def format_response_output(content: str) -> any:
@@ -71,82 +199,130 @@ class Dialog(ABC):
         :param content: 模型回复内容
         :return: 结构化字典或原始内容
         """
-        def extract_json(text):
-            # 优先提取代码块里的内容
-            match = re.search(r"```json\s*([\s\S]*?)\s*```", text)
-            if match:
-                return match.group(1)
-            # 匹配数组或对象
-            match = re.search(r"(\[[\s\S]*\]|\{[\s\S]*\})", text)
-            if match:
-                return match.group(1)
-            return text
-        json_str = extract_json(content)
+        json_str = _extract_json(content)
         try:
-            res = json.loads(json_str)
+            res = _loads(json_str)
         except Exception as e:
             print(f"[WARN] JSON解析失败，返回原始内容: {e}")
             res = content
         return res
 
-    def _get_chat_completion(self, messages):
+    def _format_json_output(self, content: str) -> any:
+        """
+        解析JSON模式下的模型回复，回复本身不是合法JSON时再从中提取
+        :param content: 模型回复内容
+        :return: 结构化字典或原始内容
+        """
+        try:
+            return _loads(content)
+        except Exception:
+            return self.format_response_output(content)
+
+    def _json_request_kwargs(self, format_output: bool) -> dict:
+        """
+        需要JSON输出时附加的请求参数
+        :param format_output: 是否格式化输出
+        :return: 请求参数
+        """
+        if format_output and self.json_mode:
+            return {"response_format": _JSON_RESPONSE_FORMAT}
+        return {}
+
+    def _get_chat_completion(self, messages, **kwargs):
         """
         同步请求模型回复
         """
-        return self.client.chat.completions.create(
-            messages=messages,
-            model=self.model_name,
-            top_p=self.top_p,
-            temperature=self.temperature,
-        )
+        # 限流和临时错误由客户端重试，这里只处理平台不支持response_format的情况
+        while True:
+            try:
+                return self.client.chat.completions.create(
+                    messages=messages,
+                    model=self.model_name,
+                    top_p=self.top_p,
+                    temperature=self.temperature,
+                    **kwargs,
+                )
+            except BadRequestError as e:
+                if "response_format" not in kwargs or not _is_response_format_error(e):
+                    raise
+                # 平台不支持原生JSON模式，之后改为从回复文本中提取JSON
+                print(f"[WARN] 当前平台不支持response_format，改为从回复中提取JSON。当前模型: {self.model_name}")
+                self.json_mode = False
+                kwargs.pop("response_format")
 
-    async def _get_chat_completion_async(self, messages):
+    async def _get_chat_completion_async(self, messages, **kwargs):
         """
         异步请求模型回复
         """
-        return await self.async_client.chat.completions.create(
-            messages=messages,
-            model=self.model_name,
-            top_p=self.top_p,
-            temperature=self.temperature,
-        )
+        # 限流和临时错误由客户端重试，这里只处理平台不支持response_format的情况
+        while True:
+            try:
+                return await self.async_client.chat.completions.create(
+                    messages=messages,
+                    model=self.model_name,
+                    top_p=self.top_p,
+                    temperature=self.temperature,
+                    **kwargs,
+                )
+            except BadRequestError as e:
+                if "response_format" not in kwargs or not _is_response_format_error(e):
+                    raise
+                # 平台不支持原生JSON模式，之后改为从回复文本中提取JSON
+                print(f"[WARN] 当前平台不支持response_format，改为从回复中提取JSON。当前模型: {self.model_name}")
+                self.json_mode = False
+                kwargs.pop("response_format")
 
-    def send(self, message: str = "", base64_image_list: list = None, image_url_list: list = None, format_output: bool = False) -> any:
+    def _check_api_key(self, client):
         """
-        发送消息到模型，并返回模型回复。
+        检查客户端是否设置了API KEY
+        :param client: 同步或异步OpenAI客户端
+        """
+        if not client.api_key:
+            raise RuntimeError(f"API KEY未设置，请检查环境变量。当前Dialog类: {self.__class__.__name__}, 当前模型: {self.model_name}")
+
+    def _add_user_input(self, message: str, base64_image_list: list = None, image_url_list: list = None, image_detail: str = None):
+        """
+        将用户的新消息（文本或图片）添加到上下文
         :param message: 用户消息
         :param base64_image_list: base64编码图片列表
         :param image_url_list: 图片url地址列表
-        :param format_output: 是否格式化输出，如果为True，则返回JSON格式，默认返回原始内容
-        :return: 模型回复或者JSON格式内容
+        :param image_detail: 图片精度（low/high/auto），默认base64图片为low，图片url由平台决定
         """
         # 如果新消息有图片
         if base64_image_list or image_url_list:
             self.context.add_image_message(
                 text_content=message,
                 base64_image_list=base64_image_list,
-                image_url_list=image_url_list
+                image_url_list=image_url_list,
+                detail=image_detail
             )
         # 如果有新消息且没有图片，添加用户消息到上下文
         if message and not base64_image_list and not image_url_list:
             self.context.add_user_message(content=message)
+
+    def send(self, message: str = "", base64_image_list: list = None, image_url_list: list = None, format_output: bool = False, image_detail: str = None) -> any:
+        """
+        发送消息到模型，并返回模型回复。
+        :param message: 用户消息
+        :param base64_image_list: base64编码图片列表
+        :param image_url_list: 图片url地址列表
+        :param format_output: 是否格式化输出，如果为True，则返回JSON格式，默认返回原始内容。
+            将json_mode设为True可使用平台原生的JSON模式，此时只能返回JSON对象（字典），需要数组时请让模型把数组放在对象的字段中
+        :param image_detail: 图片精度（low/high/auto），默认base64图片为low，图片url由平台决定
+        :return: 模型回复或者JSON格式内容
+        """
+        self._add_user_input(message, base64_image_list, image_url_list, image_detail)
         # 构建消息列表
-        messages = []
+        messages = self.context.to_openai_messages()
+        # JSON格式要求只附加在本次请求中，不写入上下文
         if format_output:
-            self.context.add_user_message('输出为JSON格式')
-        for m in self.context.messages:
-            if isinstance(m.get("content"), str):
-                messages.append({"role": m["role"], "content": m["content"]})
-            elif isinstance(m.get("content"), list):
-                messages.append({"role": m["role"], "content": m["content"]})
-        # 检查API KEY
-        if not self.client.api_key:
-            raise RuntimeError(f"API KEY未设置，请检查环境变量。当前Dialog类: {self.__class__.__name__}, 当前模型: {self.model_name}")
+            messages.append(_JSON_OUTPUT_MESSAGE)
+        self._check_api_key(self.client)
         try:
-            chat_completion = self._get_chat_completion(messages)
+            chat_completion = self._get_chat_completion(messages, **self._json_request_kwargs(format_output))
             content = chat_completion.choices[0].message.content
             if format_output:
-                res = self.format_response_output(content)
+                res = self._format_json_output(content)
             else:
                 res = content
             self.context.add_assistant_message(str(res))
@@ -157,41 +333,56 @@ class Dialog(ABC):
             self.context.add_assistant_message(res)
             return res
 
-    async def async_send(self, message: str = None, base64_image_list: list = None, image_url_list: list = None, format_output: bool = False) -> any:
+    def send_batch(self, messages: list) -> list:
+        """
+        将多个互不相关的任务合并为一次请求发送，共享上下文中的系统提示词，并按顺序拆分模型回复。
+        所有任务的回复解析成功后才会写入上下文。
+        :param messages: 任务消息列表
+        :return: 与messages一一对应的回复列表，请求或解析失败时各位置为空字符串
+        """
+        if not messages:
+            return []
+        task_count = len(messages)
+        tasks = "\n".join(f"{i}. {m}" for i, m in enumerate(messages, 1))
+        prompt = f"请依次完成以下{task_count}个任务，输出为JSON数组格式，数组长度为{task_count}，第i个元素为第i个任务的回答。\n{tasks}"
+        self._check_api_key(self.client)
+        try:
+            chat_completion = self._get_chat_completion(self.context.to_openai_messages() + [{"role": ROLE_USER, "content": prompt}])
+            content = chat_completion.choices[0].message.content
+        except Exception as e:
+            print(f"[ERROR] 获取模型回复失败: {e}")
+            return [''] * task_count
+        res = self.format_response_output(content)
+        if not isinstance(res, list) or len(res) != task_count:
+            print(f"[WARN] 批量任务回复无法拆分为{task_count}个结果，返回空结果")
+            return [''] * task_count
+        self.context.add_user_message(prompt)
+        self.context.add_assistant_message(str(res))
+        return res
+
+    async def async_send(self, message: str = None, base64_image_list: list = None, image_url_list: list = None, format_output: bool = False, image_detail: str = None) -> any:
         """
         异步发送消息到模型，并返回模型回复。
         :param message: 用户消息
         :param base64_image_list: base64编码图片列表
         :param image_url_list: 图片url地址列表
-        :param format_output: 是否格式化输出，如果为True，则返回JSON格式，默认返回原始内容
+        :param format_output: 是否格式化输出，如果为True，则返回JSON格式，默认返回原始内容。
+            将json_mode设为True可使用平台原生的JSON模式，此时只能返回JSON对象（字典），需要数组时请让模型把数组放在对象的字段中
+        :param image_detail: 图片精度（low/high/auto），默认base64图片为low，图片url由平台决定
         :return: 模型回复或者JSON格式内容
         """
-        # 如果新消息有图片
-        if base64_image_list or image_url_list:
-            self.context.add_image_message(
-                text_content=message,
-                base64_image_list=base64_image_list,
-                image_url_list=image_url_list
-            )
-        # 如果有新消息且没有图片，添加用户消息到上下文
-        if message and not base64_image_list and not image_url_list:
-            self.context.add_user_message(content=message)
+        self._add_user_input(message, base64_image_list, image_url_list, image_detail)
         # 构建消息列表
-        messages = []
+        messages = self.context.to_openai_messages()
+        # JSON格式要求只附加在本次请求中，不写入上下文
         if format_output:
-            self.context.add_user_message('输出为JSON格式')
-        for m in self.context.messages:
-            if isinstance(m.get("content"), str):
-                messages.append({"role": m["role"], "content": m["content"]})
-            elif isinstance(m.get("content"), list):
-                messages.append({"role": m["role"], "content": m["content"]})
-        if not self.async_client.api_key:
-            raise RuntimeError(f"API KEY未设置，请检查环境变量。当前Dialog类: {self.__class__.__name__}, 当前模型: {self.model_name}")
+            messages.append(_JSON_OUTPUT_MESSAGE)
+        self._check_api_key(self.async_client)
         try:
-            chat_completion = await self._get_chat_completion_async(messages)
+            chat_completion = await self._get_chat_completion_async(messages, **self._json_request_kwargs(format_output))
             content = chat_completion.choices[0].message.content
             if format_output:
-                res = self.format_response_output(content)
+                res = self._format_json_output(content)
             else:
                 res = content
             self.context.add_assistant_message(str(res))
@@ -202,19 +393,177 @@ class Dialog(ABC):
             self.context.add_assistant_message(res)
             return res
 
+    def stream_send(self, message: str = "", base64_image_list: list = None, image_url_list: list = None, on_token=None, image_detail: str = None):
+        """
+        以流式方式发送消息到模型，逐段返回模型回复，完整回复在结束后写入上下文。
+        :param message: 用户消息
+        :param base64_image_list: base64编码图片列表
+        :param image_url_list: 图片url地址列表
+        :param on_token: 可选回调，每收到一段回复时调用
+        :param image_detail: 图片精度（low/high/auto），默认base64图片为low，图片url由平台决定
+        :return: 生成器，逐段产出模型回复文本
+        """
+        self._add_user_input(message, base64_image_list, image_url_list, image_detail)
+        self._check_api_key(self.client)
+        tokens = []
+        try:
+            for chunk in self._get_chat_completion(self.context.to_openai_messages(), stream=True):
+                token = chunk.choices[0].delta.content if chunk.choices else None
+                if token:
+                    tokens.append(token)
+                    if on_token:
+                        on_token(token)
+                    yield token
+        # 只处理请求和读取流时的错误，on_token回调抛出的异常直接交给调用方
+        except (OpenAIError, httpx.HTTPError) as e:
+            print(f"[ERROR] 获取模型回复失败: {e}")
+        finally:
+            # 调用方提前结束迭代时也保证上下文中用户消息与回复成对
+            self.context.add_assistant_message("".join(tokens))
+
+    async def async_stream_send(self, message: str = None, base64_image_list: list = None, image_url_list: list = None, on_token=None, image_detail: str = None):
+        """
+        以流式方式异步发送消息到模型，逐段返回模型回复，完整回复在结束后写入上下文。
+        :param message: 用户消息
+        :param base64_image_list: base64编码图片列表
+        :param image_url_list: 图片url地址列表
+        :param on_token: 可选回调，每收到一段回复时调用
+        :param image_detail: 图片精度（low/high/auto），默认base64图片为low，图片url由平台决定
+        :return: 异步生成器，逐段产出模型回复文本
+        """
+        self._add_user_input(message, base64_image_list, image_url_list, image_detail)
+        self._check_api_key(self.async_client)
+        tokens = []
+        try:
+            async for chunk in await self._get_chat_completion_async(self.context.to_openai_messages(), stream=True):
+                token = chunk.choices[0].delta.content if chunk.choices else None
+                if token:
+                    tokens.append(token)
+                    if on_token:
+                        on_token(token)
+                    yield token
+        # 只处理请求和读取流时的错误，on_token回调抛出的异常直接交给调用方
+        except (OpenAIError, httpx.HTTPError) as e:
+            print(f"[ERROR] 获取模型回复失败: {e}")
+        finally:
+            # 调用方提前结束迭代时也保证上下文中用户消息与回复成对
+            self.context.add_assistant_message("".join(tokens))
+
+    async def batch_async_send(self, messages: list, format_output: bool = False, concurrency: int = 8) -> list:
+        """
+        基于当前上下文并发发送多条互不相关的消息，并按顺序返回模型回复。
+        每条消息各自独立请求，不会写入上下文。
+        :param messages: 用户消息列表
+        :param format_output: 是否格式化输出，如果为True，则返回JSON格式，默认返回原始内容
+        :param concurrency: 最大并发请求数
+        :return: 与messages一一对应的模型回复列表，请求失败的位置为空字符串
+        """
+        self._check_api_key(self.async_client)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def _send_one(message):
+            # 每个请求使用独立的消息列表，避免并发请求之间共享对上下文的修改
+            payload = self.context.to_openai_messages() + [{"role": ROLE_USER, "content": message}]
+            if format_output:
+                payload.append(_JSON_OUTPUT_MESSAGE)
+            async with semaphore:
+                try:
+                    chat_completion = await self._get_chat_completion_async(payload, **self._json_request_kwargs(format_output))
+                    content = chat_completion.choices[0].message.content
+                    if format_output:
+                        return self._format_json_output(content)
+                    return content
+                except Exception as e:
+                    print(f"[ERROR] 获取模型回复失败: {e}")
+                    return ''
+
+        return await asyncio.gather(*[_send_one(m) for m in messages])
+
+    def submit_batch(self, prompts: list, format_output: bool = False) -> str:
+        """
+        通过Batch API提交批量任务（价格更低，24小时内完成），每条消息基于当前上下文独立请求，不会写入上下文。
+        :param prompts: 用户消息列表
+        :param format_output: 是否要求模型输出JSON格式
+        :return: 批量任务ID，用于 wait_for_batch 获取结果
+        """
+        self._check_api_key(self.client)
+        lines = []
+        for i, prompt in enumerate(prompts):
+            payload = self.context.to_openai_messages() + [{"role": ROLE_USER, "content": prompt}]
+            if format_output:
+                payload.append(_JSON_OUTPUT_MESSAGE)
+            lines.append(json.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model_name,
+                    "messages": payload,
+                    "top_p": self.top_p,
+                    "temperature": self.temperature,
+                    **self._json_request_kwargs(format_output),
+                },
+            }, ensure_ascii=False))
+        batch_file = self.client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    def wait_for_batch(self, batch_id: str, format_output: bool = False, poll_interval: float = 10) -> list:
+        """
+        轮询等待批量任务结束，并按提交顺序返回模型回复。
+        任务过期（expired）或被取消（cancelled）时，仍返回其中已完成的回复。
+        :param batch_id: submit_batch 返回的批量任务ID
+        :param format_output: 是否格式化输出，如果为True，则返回JSON格式，默认返回原始内容
+        :param poll_interval: 轮询间隔（秒）
+        :return: 与提交的消息一一对应的模型回复列表，请求失败或未完成的位置为空字符串
+        :raises RuntimeError: 批量任务整体失败（failed）时抛出
+        """
+        batch = self.client.batches.retrieve(batch_id)
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(poll_interval)
+            batch = self.client.batches.retrieve(batch_id)
+        if batch.status == "failed":
+            raise RuntimeError(f"批量任务失败，任务ID: {batch_id}，错误: {batch.errors}")
+        if batch.status != "completed":
+            print(f"[WARN] 批量任务未全部完成，状态: {batch.status}，任务ID: {batch_id}，仅返回已完成的回复")
+        results = [''] * (batch.request_counts.total if batch.request_counts else 0)
+        if not batch.output_file_id:
+            return results
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            item = _loads(line)
+            response = item.get("response") or {}
+            if item.get("error") or response.get("status_code") != 200:
+                print(f"[ERROR] 批量请求失败: custom_id={item.get('custom_id')}, 错误: {item.get('error') or response.get('body')}")
+                continue
+            content = response["body"]["choices"][0]["message"]["content"] or ''
+            index = int(item["custom_id"])
+            if index >= len(results):
+                results.extend([''] * (index + 1 - len(results)))
+            results[index] = self._format_json_output(content) if format_output else content
+        return results
+
 
 class GenericDialog(Dialog):
     def __init__(self, model_name: str, system_prompt: str = "", api_key_env: str = None, base_url: str = None):
         super().__init__(model_name)
         self._context = OpenAIContext(system_prompt=system_prompt)
-        # 初始化时候从环境变量获取API Key，但是实例化之后改变这个变量并不能修改client的api_key属性
-        _tmp_ak_v = os.getenv(api_key_env) if api_key_env else None
-        if base_url:
-            self._client = OpenAI(base_url=base_url, api_key=_tmp_ak_v)
-            self._async_client = AsyncOpenAI(base_url=base_url, api_key=_tmp_ak_v)
-        else:
-            self._client = OpenAI(api_key=_tmp_ak_v)
-            self._async_client = AsyncOpenAI(api_key=_tmp_ak_v)
+        # API Key在模块加载时从环境变量读取并缓存，之后再修改环境变量不会影响新建的Dialog
+        self._api_key = _get_api_key(api_key_env) if api_key_env else None
+        self._base_url = base_url
+        # 客户端在首次使用时才创建，只用同步或只用异步接口时不会多创建一个
+        self._client = None
+        self._async_client = None
+        # 事件循环 -> 使用该循环共享连接池的异步客户端
+        self._async_clients = {}
 
     @property
     def context(self):
@@ -222,11 +571,30 @@ class GenericDialog(Dialog):
 
     @property
     def client(self):
+        if self._client is None:
+            self._client = OpenAI(base_url=self._base_url, api_key=self._api_key, max_retries=_MAX_RETRIES, http_client=_HTTP_CLIENT)
         return self._client
 
     @property
     def async_client(self):
-        return self._async_client
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中访问时，无法确定连接池所属的循环，使用客户端自带的连接池
+            if self._async_client is None:
+                self._async_client = AsyncOpenAI(base_url=self._base_url, api_key=self._api_key, max_retries=_MAX_RETRIES)
+            return self._async_client
+        async_client = self._async_clients.get(loop)
+        if async_client is None:
+            _drop_closed_loops(self._async_clients)
+            async_client = AsyncOpenAI(
+                base_url=self._base_url,
+                api_key=self._api_key,
+                max_retries=_MAX_RETRIES,
+                http_client=_get_async_http_client(loop),
+            )
+            self._async_clients[loop] = async_client
+        return async_client
 
 
 class OpenRouterDialog(GenericDialog):
@@ -272,6 +640,8 @@ class DMXDialog(GenericDialog):
 if __name__ == '__main__':
     # dialog = DMXDialog(model_name="deepseek-ai/DeepSeek-V3", area='en')
     dialog = DMXDialog(model_name='deepseek-v3.1',system_prompt='你是AI助手', area='en')
+    # 开启平台原生的JSON模式后只能返回对象，此时需要让模型把列表放在对象的字段中
+    # dialog.json_mode = True
 
     # 发送测试消息
     result = dialog.send(
@@ -0,0 +1,48 @@
+"""
+预热tiktoken的BPE文件缓存
+
+首次调用 tiktoken.encoding_for_model 时需要下载并解析BPE文件，会让第一次 get_token_count 明显变慢。
+在部署（如Docker镜像构建、CI）阶段执行本脚本，把用到的编码器提前写入 TIKTOKEN_CACHE_DIR，
+之后的进程直接命中磁盘缓存。
+
+用法：
+    python scripts/load_tiktoken.py [模型名 ...]
+"""
+import os
+import sys
+
+from dotenv import load_dotenv
+import tiktoken
+
+# 项目中默认使用到的模型，tiktoken不认识的模型（火山方舟、OpenRouter、DMX上的第三方模型）会回退到cl100k_base
+DEFAULT_MODELS = [
+    "gpt-3.5-turbo",
+    "gpt-4",
+    "gpt-4o",
+    "deepseek-v3.1",
+]
+
+
+def load_encodings(model_names: list) -> set:
+    """
+    加载模型对应的编码器，使BPE文件写入本地缓存
+    :param model_names: 模型名称列表
+    :return: 已加载的编码器名称集合
+    """
+    encoding_names = set()
+    for model_name in model_names:
+        try:
+            encoding_names.add(tiktoken.encoding_name_for_model(model_name))
+        except KeyError:
+            encoding_names.add("cl100k_base")
+    for encoding_name in sorted(encoding_names):
+        tiktoken.get_encoding(encoding_name)
+        print(f"[INFO] 已加载编码器: {encoding_name}")
+    return encoding_names
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    if not os.getenv("TIKTOKEN_CACHE_DIR"):
+        print("[WARN] 未设置 TIKTOKEN_CACHE_DIR，BPE文件将缓存到系统临时目录，重启后可能失效")
+    load_encodings(sys.argv[1:] or DEFAULT_MODELS)
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from modelhub import dialog
+
+
+class _ChatCompletionHandler(BaseHTTPRequestHandler):
+    # 使用HTTP/1.1保持连接，模拟连接池中的keep-alive连接
+    protocol_version = "HTTP/1.1"
+    # 最近一次请求的请求体和要返回的回复内容
+    last_request = None
+    reply_content = "ok"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        _ChatCompletionHandler.last_request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        data = json.dumps({
+            "id": "chatcmpl-test",
+            "object": "chat.completion",
+            "created": 0,
+            "model": "test-model",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": self.reply_content}}],
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def base_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ChatCompletionHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    server.shutdown()
+    server.server_close()
+
+
+def test_async_clients_released_after_loops_close(base_url, monkeypatch):
+    monkeypatch.setitem(dialog._API_KEYS, "MODELHUB_TEST_API_KEY", "test-key")
+    test_dialog = dialog.GenericDialog("test-model", api_key_env="MODELHUB_TEST_API_KEY", base_url=base_url)
+    for _ in range(5):
+        assert asyncio.run(test_dialog.async_send("hi")) == "ok"
+    # 每次asyncio.run都会新建事件循环，已关闭的循环及其连接池不应被一直保留
+    assert len(dialog._ASYNC_HTTP_CLIENTS) == 1
+    assert len(test_dialog._async_clients) == 1
+
+
+def test_format_output_keeps_json_array_by_default(base_url, monkeypatch):
+    monkeypatch.setitem(dialog._API_KEYS, "MODELHUB_TEST_API_KEY", "test-key")
+    monkeypatch.setattr(_ChatCompletionHandler, "reply_content", '```json\n[{"name": "iPhone 15"}]\n```')
+    test_dialog = dialog.GenericDialog("test-model", api_key_env="MODELHUB_TEST_API_KEY", base_url=base_url)
+    # 默认不使用原生JSON模式，模型回复的数组照常返回
+    assert test_dialog.send("hi", format_output=True) == [{"name": "iPhone 15"}]
+    assert "response_format" not in _ChatCompletionHandler.last_request
+
+
+def _batch_line(index, content):
+    return json.dumps({
+        "custom_id": str(index),
+        "response": {"status_code": 200, "body": {"choices": [{"message": {"content": content}}]}},
+        "error": None,
+    })
+
+
+def _batch_dialog(monkeypatch, status, lines):
+    monkeypatch.setitem(dialog._API_KEYS, "MODELHUB_TEST_API_KEY", "test-key")
+    test_dialog = dialog.GenericDialog("test-model", api_key_env="MODELHUB_TEST_API_KEY", base_url="http://127.0.0.1/v1")
+    batch = SimpleNamespace(status=status, request_counts=SimpleNamespace(total=3), output_file_id="file-out", errors=None)
+    monkeypatch.setattr(test_dialog.client.batches, "retrieve", lambda batch_id: batch)
+    monkeypatch.setattr(test_dialog.client.files, "content", lambda file_id: SimpleNamespace(text="\n".join(lines)))
+    return test_dialog
+
+
+def test_wait_for_batch_returns_finished_results_of_expired_batch(monkeypatch):
+    test_dialog = _batch_dialog(monkeypatch, "expired", [_batch_line(0, '{"a": 1}'), _batch_line(2, None)])
+    # 已完成的回复照常返回，未完成的位置和空回复为空字符串
+    assert test_dialog.wait_for_batch("batch-test", format_output=True) == [{"a": 1}, '', '']
+
+
+def test_wait_for_batch_raises_on_failed_batch(monkeypatch):
+    test_dialog = _batch_dialog(monkeypatch, "failed", [])
+    with pytest.raises(RuntimeError):
+        test_dialog.wait_for_batch("batch-test")